@@ -19,11 +19,13 @@ pykuang.blacklist
 
 import logging
 import re
+from bisect import bisect_right
 from dataclasses import dataclass, field
+from functools import cache
 from ipaddress import (IPv4Address, IPv4Network, IPv6Address, IPv6Network,
                        ip_address, ip_network)
 from threading import Lock
-from typing import Final, Sequence, Union
+from typing import Final, Optional, Sequence, Union
 
 from pykuang import common
 
@@ -123,12 +125,30 @@ class NameBlacklistItem:
 
 @dataclass(kw_only=True, slots=True)
 class NameBlacklist:
-    """A list of patterns to match hostnames."""
+    """A list of patterns to match hostnames.
+
+    When the NameBlacklist is created, all patterns are joined into a single
+    regular expression, so changes to <patterns> after that are not picked up.
+    Patterns that contain groups cannot be joined, because their group numbers and
+    backreferences would change meaning, so in that case we try each pattern in turn.
+    """
 
     patterns: list[NameBlacklistItem] = field(default_factory=list)
     lock: Lock = field(default_factory=Lock)
     log: logging.Logger = field(default_factory=lambda: common.get_logger("bl_name"))
     dbg: bool = True
+    _union: Optional[re.Pattern] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self._union = None
+        flags: Final[set[int]] = {x.pat.flags for x in self.patterns}
+        if len(flags) != 1 or any(x.pat.groups > 0 for x in self.patterns):
+            return
+        try:
+            self._union = re.compile("|".join(f"(?:{x.pat.pattern})" for x in self.patterns),
+                                     flags.pop())
+        except re.error as err:
+            self.log.error("Cannot join name patterns into one: %s", err)
 
     @classmethod
     def from_list(cls, names: Sequence[Union[str, re.Pattern]]) -> 'NameBlacklist':
@@ -153,6 +173,13 @@ class NameBlacklist:
 
     def is_match(self, name: str) -> bool:
         """Return True if an item in the Blacklist matches the given name."""
+        # Most names do not match at all, and a single search with the joined
+        # pattern tells us so much faster than trying each pattern in turn.
+        # Only for the names that do match, we find out which pattern it was.
+        if self._union is not None and \
+           self._union.search(name) is None:  # pylint: disable-msg=E1101
+            return False
+
         with self.lock:
             for pat in self.patterns:
                 if pat.is_match(name):
@@ -180,14 +207,63 @@ class IPBlacklistItem:
         return False
 
 
+@dataclass(slots=True)
+class RangeIndex:
+    """RangeIndex looks up addresses in a list of address ranges by bisection.
+
+    The ranges are sorted by their first address. reach[i] is the highest last address
+    of all ranges up to and including i, so a lookup can stop as soon as no range to the
+    left can contain the address, even if ranges overlap or are nested.
+    """
+
+    starts: list[int]
+    ends: list[int]
+    reach: list[int]
+    items: list[IPBlacklistItem]
+
+    @classmethod
+    def build(cls, items: Sequence[IPBlacklistItem]) -> 'RangeIndex':
+        """Build a RangeIndex from a list of IPBlacklistItems."""
+        ordered = sorted(items, key=lambda x: int(x.net.network_address))
+        idx = RangeIndex(starts=[], ends=[], reach=[], items=ordered)
+        reach: int = -1
+
+        for item in ordered:
+            end: int = int(item.net.broadcast_address)
+            reach = max(reach, end)
+            idx.starts.append(int(item.net.network_address))
+            idx.ends.append(end)
+            idx.reach.append(reach)
+
+        return idx
+
+    def lookup(self, ip: int) -> Optional[IPBlacklistItem]:
+        """Return the item whose range contains <ip>, or None."""
+        i: int = bisect_right(self.starts, ip) - 1
+        while i >= 0 and self.reach[i] >= ip:
+            if self.ends[i] >= ip:
+                return self.items[i]
+            i -= 1
+        return None
+
+
 @dataclass(kw_only=True, slots=True)
 class IPBlacklist:
-    """IPBlacklist is a list of IP address ranges that are blacklisted."""
+    """IPBlacklist is a list of IP address ranges that are blacklisted.
+
+    The list is indexed when the IPBlacklist is created, so changes to <networks>
+    after that are not picked up.
+    """
 
     networks: list[IPBlacklistItem]
-    lock: Lock = field(default_factory=Lock)
     log: logging.Logger = field(default_factory=lambda: common.get_logger("bl_addr"))
     dbg: bool = True
+    _v4: RangeIndex = field(init=False)
+    _v6: RangeIndex = field(init=False)
+
+    def __post_init__(self) -> None:
+        self._v4 = RangeIndex.build([x for x in self.networks if x.net.version == 4])
+        self._v6 = RangeIndex.build([x for x in self.networks if x.net.version == 6])
 
     @classmethod
     def from_list(cls, lst: Sequence[Union[IPv4Network, IPv6Network, str]]) -> 'IPBlacklist':
@@ -202,12 +278,23 @@ class IPBlacklist:
 
     @classmethod
     def default(cls) -> 'IPBlacklist':
-        """Return an IPBlacklist of the default networks."""
-        return cls.from_list(forbidden_networks)
+        """Return an IPBlacklist of the default networks.
 
-    def is_match(self, addr: Union[str, IPv4Address, IPv6Address]) -> bool:
-        """Return True if <addr> is in any of the blacklisted address ranges."""
-        with self.lock:
+        The default IPBlacklist is built once and shared by all callers. Its index
+        is never modified after construction, so this is safe across threads.
+        """
+        return _default_ip_blacklist()
+
+    def is_match(self, addr: Union[int, str, IPv4Address, IPv6Address]) -> bool:
+        """Return True if <addr> is in any of the blacklisted address ranges.
+
+        A plain int is taken to be an IPv4 address.
+        """
+        item: Optional[IPBlacklistItem] = None
+
+        if isinstance(addr, int):
+            item = self._v4.lookup(addr)
+        else:
             if isinstance(addr, str):
                 try:
                     addr = ip_address(addr)
@@ -215,12 +302,21 @@ class IPBlacklist:
                     self.log.error("'%s' does not look like an IP address: %s.",
                                    addr,
                                    verr)
-            assert not isinstance(addr, str)
-            for net in self.networks:
-                if net.is_match(addr):
-                    self.networks.sort(key=lambda x: x.hit_cnt, reverse=True)
-                    return True
-        return False
+                    return False
+
+            idx: Final[RangeIndex] = self._v4 if addr.version == 4 else self._v6
+            item = idx.lookup(int(addr))
+
+        if item is None:
+            return False
+        item.hit_cnt += 1
+        return True
+
+
+@cache
+def _default_ip_blacklist() -> IPBlacklist:
+    """Build the shared default IPBlacklist."""
+    return IPBlacklist.from_list(forbidden_networks)
 
 # Local Variables: #
 # python-indent: 4 #
@@ -20,9 +20,11 @@ import sqlite3
 from datetime import datetime
 from enum import Enum, auto
 from ipaddress import IPv4Address, IPv6Address, ip_address
+from itertools import chain, groupby
+from operator import itemgetter
 from pathlib import Path
 from threading import Lock
-from typing import Final, Optional, Union
+from typing import Final, Optional, Sequence, Union
 
 import krylib
 
@@ -95,13 +97,22 @@ CREATE TABLE xfr (
 ]
 
 
+# host_add_rows inserts this many rows per statement. At four parameters per
+# row, this stays well below the limit of 999 parameters that older versions
+# of SQLite impose.
+host_chunk_size: Final[int] = 200
+
+
 class Query(Enum):
     """Query identifies a particular operation on the database."""
 
     HostAdd = auto()
+    HostAddMany = auto()
+    HostAddChunk = auto()
     HostGetByAddr = auto()
     HostGetByID = auto()
     HostGetRandom = auto()
+    HostGetRandomWithPorts = auto()
     HostGetNoXFR = auto()
     HostGetAll = auto()
     HostUpdateLastContact = auto()
@@ -110,10 +121,12 @@ class Query(Enum):
     HostSetXfr = auto()
 
     SvcAdd = auto()
+    SvcAddMany = auto()
     SvcGetByPort = auto()
     SvcGetByHost = auto()
 
     XfrAdd = auto()
+    XfrAddNew = auto()
     XfrStart = auto()
     XfrEnd = auto()
     XfrGetUnstarted = auto()
@@ -123,7 +136,20 @@ class Query(Enum):
 
 
 qdb: Final[dict[Query, str]] = {
-    Query.HostAdd: "INSERT INTO host (name, addr, src, added) VALUES (?, ?, ?, ?) RETURNING id",
+    Query.HostAdd: """
+INSERT INTO host (name, addr, src, added)
+          VALUES (   ?,    ?,   ?,     ?)
+ON CONFLICT (addr) DO NOTHING
+RETURNING id
+""",
+    Query.HostAddMany: """
+INSERT INTO host (name, addr, src, added)
+          VALUES (   ?,    ?,   ?,     ?)
+ON CONFLICT (addr) DO NOTHING
+""",
+    Query.HostAddChunk: "INSERT INTO host (name, addr, src, added) VALUES " +
+                        ", ".join(["(?, ?, ?, ?)"] * host_chunk_size) +
+                        "\nON CONFLICT (addr) DO NOTHING",
     Query.HostGetByAddr: """
 SELECT
     id,
@@ -151,6 +177,14 @@ FROM host
 WHERE id = ?
     """,
     Query.HostGetRandom: """
+WITH RECURSIVE pick (n, id) AS (
+    SELECT 1, 1 + ABS(RANDOM()) % COALESCE((SELECT MAX(id) FROM host), 1)
+    UNION ALL
+    SELECT n + 1, 1 + ABS(RANDOM()) % COALESCE((SELECT MAX(id) FROM host), 1)
+    FROM pick
+    WHERE n < ?
+)
+
 SELECT
     id,
     addr,
@@ -162,9 +196,46 @@ SELECT
     location,
     xfr
 FROM host
-ORDER BY COALESCE(last_contact, 0) DESC
-LIMIT ?
-OFFSET ABS(RANDOM()) % MAX((SELECT COUNT(*) FROM host), 1)
+WHERE id IN (SELECT id FROM pick)
+    """,
+    Query.HostGetRandomWithPorts: """
+WITH RECURSIVE pick (n, id) AS (
+    SELECT 1, 1 + ABS(RANDOM()) % COALESCE((SELECT MAX(id) FROM host), 1)
+    UNION ALL
+    SELECT n + 1, 1 + ABS(RANDOM()) % COALESCE((SELECT MAX(id) FROM host), 1)
+    FROM pick
+    WHERE n < ?
+),
+
+sample AS (
+    SELECT
+        id,
+        addr,
+        name,
+        src,
+        added,
+        last_contact,
+        sysname,
+        location,
+        xfr
+    FROM host
+    WHERE id IN (SELECT id FROM pick)
+)
+
+SELECT
+    h.id,
+    h.addr,
+    h.name,
+    h.src,
+    h.added,
+    h.last_contact,
+    h.sysname,
+    h.location,
+    h.xfr,
+    s.port
+FROM sample h
+LEFT OUTER JOIN svc s ON s.host_id = h.id
+ORDER BY h.id
     """,
     Query.HostGetNoXFR: """
 SELECT
@@ -202,6 +273,11 @@ FROM host
 INSERT INTO svc (host_id, port, added, response)
          VALUES (      ?,    ?,     ?,        ?)
 RETURNING id
+""",
+    Query.SvcAddMany: """
+INSERT INTO svc (host_id, port, added, response)
+         VALUES (      ?,    ?,     ?,        ?)
+ON CONFLICT (host_id, port) DO NOTHING
 """,
     Query.SvcGetByHost: """
 SELECT
@@ -214,6 +290,11 @@ WHERE host_id = ?
 ORDER BY port
     """,
     Query.XfrAdd: "INSERT INTO xfr (name, added) VALUES (?, ?) RETURNING id",
+    Query.XfrAddNew: """
+INSERT INTO xfr (name, added) VALUES (?, ?)
+ON CONFLICT (name) DO NOTHING
+RETURNING id
+    """,
     Query.XfrStart: "UPDATE xfr SET started = ? WHERE id = ?",
     Query.XfrEnd: "UPDATE xfr SET finished = ?, status = ? WHERE id = ?",
     Query.XfrGetUnstarted: """
@@ -260,6 +341,7 @@ class Database:
         "db",
         "log",
         "path",
+        "tx_depth",
     ]
 
     def __init__(self, path: Optional[Union[Path, str]] = None) -> None:
@@ -274,6 +356,7 @@ class Database:
 
         self.log = common.get_logger("database")
         self.log.debug("Open database at %s", self.path)
+        self.tx_depth = 0
 
         with open_lock:
             exist: Final[bool] = krylib.fexist(str(self.path))
@@ -283,6 +366,11 @@ class Database:
             cur: Final[sqlite3.Cursor] = self.db.cursor()
             cur.execute("PRAGMA foreign_keys = true")
             cur.execute("PRAGMA journal_mode = WAL")
+            # In WAL mode, NORMAL only syncs on checkpoints. A crash may lose the
+            # last few transactions, but it cannot corrupt the database, and we
+            # can easily live with rescanning a few hosts.
+            cur.execute("PRAGMA synchronous = NORMAL")
+            cur.execute("PRAGMA temp_store = MEMORY")
 
             if not exist:
                 self.__create_db()
@@ -309,14 +397,39 @@ class Database:
         # self.db = None
         del self.db
 
+    # Since the connection runs in autocommit mode, the sqlite3 module's own
+    # context manager would only commit each statement on its own. We begin
+    # and end the transaction explicitly instead, so everything inside a
+    # "with db:" block is committed at once. Nested blocks join the outermost
+    # transaction.
+
     def __enter__(self) -> None:
-        self.db.__enter__()
+        if self.tx_depth == 0:
+            self.db.execute("BEGIN IMMEDIATE")
+        self.tx_depth += 1
 
     def __exit__(self, ex_type, ex_val, tb):
-        return self.db.__exit__(ex_type, ex_val, tb)
+        self.tx_depth -= 1
+        if self.tx_depth == 0:
+            if ex_type is None:
+                try:
+                    self.db.execute("COMMIT")
+                except sqlite3.Error:
+                    # If the COMMIT fails, e.g. because the database is busy, the
+                    # transaction is still open. We roll it back, so the next
+                    # "with db:" can begin a new one.
+                    self.db.execute("ROLLBACK")
+                    raise
+            else:
+                self.db.execute("ROLLBACK")
+        return False
+
+    def host_add(self, host: Host) -> bool:
+        """Add a Host to the Database.
 
-    def host_add(self, host: Host) -> None:
-        """Add a Host to the Database."""
+        Return True if the Host was added, False if a Host with the same address
+        is already in the Database.
+        """
         now: Final[datetime] = datetime.now()
         cur: Final[sqlite3.Cursor] = self.db.cursor()
         cur.execute(qdb[Query.HostAdd], (host.name,
@@ -325,11 +438,37 @@ class Database:
                                          int(now.timestamp())))
         row = cur.fetchone()
         if row is None:
-            msg = f"Adding Host {host.addr}/{host.name} did not return an ID"
-            self.log.error(msg)
-            raise DBError(msg)
+            return False
         host.host_id = row[0]
         host.added = now
+        return True
+
+    def host_add_rows(self, rows: Sequence[tuple[str, str, int, int]]) -> int:
+        """Add several Hosts, given as raw rows, to the Database in one go.
+
+        Each row consists of name, address, source, and timestamp (in seconds
+        since the epoch), as the host table stores them.
+        Return the number of Hosts that were added.
+        """
+        # Rows are inserted host_chunk_size at a time with a multi-row INSERT,
+        # the remainder goes through executemany.
+        full: Final[int] = len(rows) - len(rows) % host_chunk_size
+        added: int = 0
+        try:
+            cur: Final[sqlite3.Cursor] = self.db.cursor()
+            for i in range(0, full, host_chunk_size):
+                cur.execute(qdb[Query.HostAddChunk],
+                            list(chain.from_iterable(rows[i:i + host_chunk_size])))
+                added += cur.rowcount
+            if full < len(rows):
+                cur.executemany(qdb[Query.HostAddMany], rows[full:])
+                added += cur.rowcount
+            return added
+        except sqlite3.Error as err:
+            cname: Final[str] = err.__class__.__name__
+            msg = f"{cname} trying to add {len(rows)} Hosts: {err}"
+            self.log.error(msg)
+            raise DBError(msg) from err
 
     def host_get_by_addr(self, addr: Union[str, IPv4Address, IPv6Address]) -> Optional[Host]:
         """Lookup a Host by its address."""
@@ -432,6 +571,37 @@ class Database:
 
         return hosts
 
+    def host_get_random_with_ports(self, cnt: int) -> list[tuple[Host, frozenset[int]]]:
+        """Get up to <cnt> random Hosts, along with the ports we have scanned on each.
+
+        This does in a single query what host_get_random and service_get_by_host
+        would do in <cnt>+1 queries.
+        """
+        assert cnt > 0, "Host count must be positive."
+        cur = self.db.cursor()
+        cur.execute(qdb[Query.HostGetRandomWithPorts], (cnt, ))
+
+        hosts: list[tuple[Host, frozenset[int]]] = []
+
+        for _, grp in groupby(cur, key=itemgetter(0)):
+            rows = list(grp)
+            row = rows[0]
+            host: Host = Host(
+                host_id=row[0],
+                addr=ip_address(row[1]),
+                name=row[2],
+                src=HostSource(row[3]),
+                added=datetime.fromtimestamp(row[4]),
+                last_contact=maybe_timestamp(row[5]),
+                sysname=row[6],
+                location=row[7],
+                xfr=(row[8] != 0),
+            )
+            ports = frozenset(r[9] for r in rows if r[9] is not None)
+            hosts.append((host, ports))
+
+        return hosts
+
     def host_get_no_xfr(self, cnt: int) -> list[Host]:
         """Get <cnt> Hosts for the XFRProcessor."""
         cur = self.db.cursor()
@@ -494,6 +664,23 @@ class Database:
             self.log.error(msg)
             raise DBError(msg) from err
 
+    def service_add_rows(self, rows: Sequence[tuple[int, int, int, Optional[str]]]) -> int:
+        """Add several scanned ports, given as raw rows, to the database in one go.
+
+        Each row consists of host ID, port, timestamp (in seconds since the epoch),
+        and response, as the svc table stores them.
+        Return the number of Services that were added.
+        """
+        try:
+            cur: Final[sqlite3.Cursor] = self.db.cursor()
+            cur.executemany(qdb[Query.SvcAddMany], rows)
+            return cur.rowcount
+        except sqlite3.Error as err:
+            cname: Final[str] = err.__class__.__name__
+            msg = f"{cname} trying to add {len(rows)} Services: {err}"
+            self.log.error(msg)
+            raise DBError(msg) from err
+
     def service_get_by_host(self, host: Host) -> list[Service]:
         """Get all scanned ports for <host>."""
         cur: Final[sqlite3.Cursor] = self.db.cursor()
@@ -525,6 +712,19 @@ class Database:
             raise DBError(msg)
         xfr.zone_id = row[0]
 
+    def xfr_add_new(self, xfr: XFR) -> bool:
+        """Add a DNS zone to the database to be XFR'ed, unless it is already there.
+
+        Return True if the zone was added.
+        """
+        cur: Final[sqlite3.Cursor] = self.db.cursor()
+        cur.execute(qdb[Query.XfrAddNew], (xfr.name, int(xfr.added.timestamp())))
+        row = cur.fetchone()
+        if row is None:
+            return False
+        xfr.zone_id = row[0]
+        return True
+
     def xfr_start(self, xfr: XFR) -> None:
         """Mark an XFR as started."""
         now = datetime.now()
@@ -17,12 +17,15 @@ pykuang.generator
 """
 
 import logging
+import sqlite3
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
-from ipaddress import IPv4Address, IPv6Address, ip_address
-from queue import Empty, Queue, ShutDown
-from random import randint
-from threading import RLock, Thread
+from ipaddress import IPv4Address, IPv6Address
+from queue import Empty, Full, Queue, ShutDown, SimpleQueue
+from random import getrandbits
+from socket import inet_ntoa
+from threading import Event, Lock, RLock, Thread
 from typing import Final, Optional, Union
 
 from dns.exception import Timeout
@@ -38,59 +41,192 @@ from pykuang.database import Database
 from pykuang.model import XFR, Host
 
 
+res_timeout: Final[float] = 2.5
+# The key the CircuitBreaker uses for the resolver we get from the system
+# configuration or the full list of nameservers.
+default_res: Final[str] = "default"
+
+
+@dataclass(kw_only=True, slots=True)
+class CircuitBreaker:
+    """CircuitBreaker keeps track of upstream resolvers that keep failing.
+
+    Once a resolver has failed more than <threshold> times, with no more than <window>
+    seconds between failures, it is considered broken until <window> seconds after its
+    last failure. After that, one more failure breaks it again, while each successful
+    query halves its failure count.
+    """
+
+    threshold: int = 10
+    window: float = 30.0
+    lock: Lock = field(default_factory=Lock)
+    failures: dict[str, tuple[int, float]] = field(default_factory=dict)
+
+    def cooldown(self, ns: str) -> float:
+        """Return the number of seconds <ns> remains broken, or 0 if it is usable."""
+        with self.lock:
+            cnt, last = self.failures.get(ns, (0, 0.0))
+        if cnt <= self.threshold:
+            return 0.0
+        return max(0.0, last + self.window - time.monotonic())
+
+    def failure(self, ns: str) -> None:
+        """Record a failed query to <ns>."""
+        now: Final[float] = time.monotonic()
+        with self.lock:
+            cnt, last = self.failures.get(ns, (0, 0.0))
+            if cnt <= self.threshold and now - last > self.window:
+                cnt = 0
+            self.failures[ns] = (cnt + 1, now)
+
+    def success(self, ns: str) -> None:
+        """Record a successful query to <ns>."""
+        with self.lock:
+            cnt, last = self.failures.get(ns, (0, 0.0))
+            if cnt > 0:
+                self.failures[ns] = (cnt // 2, last)
+
+
 @dataclass(kw_only=True, slots=True)
 class HostGenerator:
     """HostGenerator generates random Hosts."""
 
-    # I could let res be initialized by a default_factory, but I might want allow for configuring
-    # custom recursive resolvers later on.
+    # If nameservers is empty, we use the system's resolver configuration.
+    # If fanout is greater than one, PTR queries are sent to up to <fanout> of the
+    # configured nameservers in parallel, and the first answer wins.
     log: logging.Logger = field(default_factory=lambda: common.get_logger("generator"))
     lock: RLock = field(default_factory=RLock)
     ipcache: CacheDB = field(init=False)
     bl_name: NameBlacklist = field(init=False)
     bl_addr: IPBlacklist = field(init=False)
     res: Resolver = field(init=False)
+    nameservers: list[str] = field(default_factory=list)
+    fanout: int = 1
+    upstream: dict[str, Resolver] = field(init=False, default_factory=dict)
+    pool: Optional[ThreadPoolExecutor] = field(init=False, default=None)
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    dbg: bool = field(init=False)
 
     def __post_init__(self) -> None:
+        self.dbg = self.log.isEnabledFor(logging.DEBUG)
         cache: Cache = Cache()
         self.ipcache = cache.get_db(CacheType.IPCache)
         self.res = Resolver()
         self.bl_addr = IPBlacklist.default()
         self.bl_name = NameBlacklist.default()
 
-        self.res.timeout = 2.5
-        self.res.lifetime = 2.5
+        self.res.timeout = res_timeout
+        self.res.lifetime = res_timeout
+
+        if len(self.nameservers) > 0:
+            self.res.nameservers = self.nameservers
+
+            for ns in self.nameservers:
+                res = Resolver(configure=False)
+                res.nameservers = [ns]
+                res.timeout = res_timeout
+                res.lifetime = res_timeout
+                self.upstream[ns] = res
+
+            if self.fanout > 1 and len(self.upstream) > 1:
+                self.pool = ThreadPoolExecutor(max_workers=self.fanout,
+                                               thread_name_prefix="resolver")
+
+    def close(self) -> None:
+        """Shut down the pool of resolver threads, if there is one.
+
+        Queries that have not been sent, yet, are cancelled, we do not wait for the
+        ones that are in flight.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
 
     def generate_ip(self, v6: bool = False) -> Union[IPv4Address, IPv6Address]:
-        """Generate a random IP."""
+        """Generate a random IP we have not looked at recently.
+
+        The address is not recorded in the IP cache here, resolve_host does that
+        once it has asked for the name. So an address that is generated, but never
+        resolved, e.g. because it was still queued when we shut down, is not lost.
+        """
         if v6:
             raise NotImplementedError("Generating IPv6 addresses is not implemented, yet.")
 
-        octets: list[int] = []
+        # Candidates are kept as plain integers, we only build an IPv4Address
+        # for the one we return.
+        ip: int = 0
+        key: str = ""
         cnt: int = 0
-        addr: Optional[Union[IPv4Address, IPv6Address]] = None
 
-        with self.ipcache.tx(True) as tx:
-            while addr is None:
-                octets = [randint(0, 255) for x in range(4)]
-                astr: str = ".".join([str(x) for x in octets])
+        with self.ipcache.tx() as tx:
+            while True:
+                ip = getrandbits(32)
                 cnt += 1
-                addr = ip_address(astr)
-                if self.bl_addr.is_match(addr) or astr not in tx:
-                    tx[astr] = "1"
-                else:
-                    addr = None
+                # The blacklist lookup is a bisection over a small in-memory
+                # list, far cheaper than formatting the key and asking the
+                # cache, so it goes first.
+                if self.bl_addr.is_match(ip):
+                    continue
+                key = inet_ntoa(ip.to_bytes(4, "big"))
+                if key not in tx:
+                    break
+
+        if self.dbg:
+            self.log.debug("Generated IP %s in %d attempts.",
+                           key,
+                           cnt)
+
+        return IPv4Address(ip)
 
-        self.log.debug("Generated IP %s in %d attempts.",
-                       astr,
-                       cnt)
+    def resolve_name(self, addr: Union[IPv4Address, IPv6Address]) -> Optional[str]:
+        """Attempt to resolve an IP address into a hostname.
+
+        If we race multiple upstream resolvers, the first one to return a name wins,
+        and queries that have not been sent, yet, are cancelled.
+        """
+        if self.pool is None:
+            self._backoff([default_res])
+            return self._query(default_res, self.res, addr)
+
+        servers: list[str] = [ns for ns in self.upstream if self.breaker.cooldown(ns) == 0]
+        if len(servers) == 0:
+            self._backoff(list(self.upstream))
+            servers = list(self.upstream)
+        servers = servers[:self.fanout]
+        futures = [self.pool.submit(self._query, ns, self.upstream[ns], addr) for ns in servers]
 
-        return addr
+        try:
+            for fut in as_completed(futures):
+                name: Optional[str] = fut.result()
+                if name is not None:
+                    return name
+        finally:
+            for fut in futures:
+                fut.cancel()
 
-    def resolve_name(self, addr: Union[IPv4Address, IPv6Address]) -> Optional[str]:
-        """Attempt to resolve an IP address into a hostname."""
+        return None
+
+    def _backoff(self, servers: list[str]) -> None:
+        """If all of <servers> are broken, wait until the first one is usable again.
+
+        We wait rather than give up on the address, because resolve_host records
+        the address in the IP cache whether we got an answer or not, so it would
+        never be tried again.
+        """
+        delay: Final[float] = min(self.breaker.cooldown(ns) for ns in servers)
+        if delay > 0:
+            self.log.debug("All upstream resolvers are failing, waiting %.1f seconds.",
+                           delay)
+            time.sleep(delay)
+
+    def _query(self,
+               ns: str,
+               res: Resolver,
+               addr: Union[IPv4Address, IPv6Address]) -> Optional[str]:
+        """Send a PTR query for <addr> to <res>, whom the CircuitBreaker knows as <ns>."""
         try:
-            answer: Answer = self.res.resolve_address(str(addr))
+            answer: Answer = res.resolve_address(str(addr))
+            self.breaker.success(ns)
             match answer.response.rcode():
                 case Rcode.NOERROR if answer.rrset is not None:
                     return answer.rrset[0].to_text()
@@ -98,39 +234,67 @@ class HostGenerator:
                     self.log.error("Unexpected response code %s",
                                    answer.response.rcode())
         except NXDOMAIN:
-            pass
+            self.breaker.success(ns)
         except NoNameservers:
-            pass
+            self.breaker.failure(ns)
             # self.log.debug("Failed to get a response for %s from upstream resolver(s): %s",
             #                addr,
             #                fail)
         except LifetimeTimeout:
-            pass
+            self.breaker.failure(ns)
         except NoAnswer:
-            pass
+            self.breaker.success(ns)
         except Timeout:
-            pass
+            self.breaker.failure(ns)
         return None
 
     def generate_host(self) -> Host:
         """Generate a random Host."""
-        addr: Optional[Union[IPv4Address, IPv6Address]] = None
-        name: Optional[str] = None
+        host: Optional[Host] = None
+
+        while host is None:
+            host = self.resolve_host(self.generate_ip())
+
+        return host
+
+    def resolve_host(self, addr: Union[IPv4Address, IPv6Address]) -> Optional[Host]:
+        """Look up the name for <addr> and return a Host, if it is not blacklisted.
 
-        while addr is None or name is None:
-            addr = self.generate_ip()
-            name = self.resolve_name(addr)
-            if name is not None and self.bl_name.is_match(name):
+        Either way, <addr> is recorded in the IP cache afterwards, so generate_ip
+        does not come up with it again.
+        """
+        name: Optional[str] = self.resolve_name(addr)
+
+        with self.ipcache.tx(True) as tx:
+            tx[str(addr)] = "1"
+
+        if name is None:
+            return None
+        if self.bl_name.is_match(name):
+            if self.dbg:
                 self.log.debug("Address %s resolves to %s, which is blacklisted.",
                                addr,
                                name)
-                name = None
+            return None
 
-        host: Host = Host(name=name, addr=addr)
-        return host
+        return Host(name=name, addr=addr)
 
 
 q_timeout: Final[int] = 5
+# How many addresses per worker we generate in advance.
+addr_backlog: Final[int] = 64
+# The host_worker adds between host_batch_min and host_batch_max Hosts per
+# transaction. When a batch comes out smaller than host_batch_small, it waits
+# host_batch_delay seconds before collecting the next one.
+host_batch_min: Final[int] = 100
+host_batch_max: Final[int] = 500
+host_batch_small: Final[int] = 10
+host_batch_delay: Final[float] = 0.05
+# If the database is locked, the host_worker tries to store a batch up to
+# host_retry_max times, waiting host_retry_delay seconds after the first failure
+# and twice as long after each one after that.
+host_retry_max: Final[int] = 5
+host_retry_delay: Final[float] = 0.5
 
 
 @dataclass(kw_only=True, slots=True)
@@ -138,32 +302,39 @@ class ParallelGenerator:
     """Generate Hosts in multiple threads to increase throughput."""
 
     wcnt: int
+    nameservers: list[str] = field(default_factory=list)
+    fanout: int = 1
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
     log: logging.Logger = field(default_factory=lambda: common.get_logger("pgen"))
     lock: RLock = field(default_factory=RLock)
-    _active: bool = False
+    _active: Event = field(default_factory=Event)
     cmdQ: Queue[Message] = field(init=False)
-    hostQ: Queue[Host] = field(init=False)
+    addrQ: Queue[Union[IPv4Address, IPv6Address]] = field(init=False)
+    hostQ: SimpleQueue[Host] = field(init=False)
     _id_cnt: int = 0
 
     def __post_init__(self) -> None:
         assert self.wcnt > 0
         self.cmdQ = Queue(self.wcnt)
-        self.hostQ = Queue(0)
+        self.addrQ = Queue(self.wcnt * addr_backlog)
+        self.hostQ = SimpleQueue()
 
     @property
     def active(self) -> bool:
         """Return the ParallelGenerator's active flag."""
-        with self.lock:
-            return self._active
+        return self._active.is_set()
 
     def start(self) -> None:
         """Start the worker threads."""
-        with self.lock:
-            self._active = True
+        self._active.set()
 
+        with self.lock:
             hw: Thread = Thread(target=self._host_worker, name="host_worker", daemon=False)
             hw.start()
 
+            aw: Thread = Thread(target=self._addr_worker, name="addr_worker", daemon=False)
+            aw.start()
+
             for _ in range(self.wcnt):
                 self._id_cnt += 1
                 wid: int = self._id_cnt
@@ -178,8 +349,9 @@ class ParallelGenerator:
         if not self.active:
             return
 
+        self._active.clear()
+
         with self.lock:
-            self._active = False
             cnt: Final[int] = self.wcnt
 
         for _ in range(cnt):
@@ -212,12 +384,40 @@ class ParallelGenerator:
             msg: Message = Message(Tag=Cmd.Stop)
             self.cmdQ.put(msg)
             if self.wcnt == 1:
-                self._active = False
+                self._active.clear()
+
+    def _addr_worker(self) -> None:
+        """Generate random addresses for the gen_workers to resolve.
+
+        Generating addresses is cheap compared to the DNS queries, so a single
+        thread can keep all gen_workers busy, and no gen_worker has to wait on
+        address generation while a PTR query is outstanding.
+        """
+        self.log.info("addr_worker reporting for work.")
+        gen: HostGenerator = HostGenerator()
+        addr: Optional[Union[IPv4Address, IPv6Address]] = None
+
+        try:
+            while self.active:
+                if addr is None:
+                    addr = gen.generate_ip()
+                try:
+                    self.addrQ.put(addr, True, q_timeout)
+                    addr = None
+                except Full:
+                    pass
+        except ShutDown:
+            self.log.info("addr_worker: AddrQueue was shut down. I'm quitting.")
+        finally:
+            gen.close()
+            self.log.info("addr_worker is finished. So long!")
 
     def _gen_worker(self, wid: int) -> None:
-        """Generate Hosts. Lots of Hosts."""
+        """Resolve addresses to Hosts. Lots of Hosts."""
         self.log.info("gen_worker #%02d reporting for work.", wid)
-        gen: HostGenerator = HostGenerator()
+        gen: HostGenerator = HostGenerator(nameservers=self.nameservers,
+                                           fanout=self.fanout,
+                                           breaker=self.breaker)
 
         try:
             while self.active:
@@ -242,39 +442,103 @@ class ParallelGenerator:
                                                message.Payload)
 
                 try:
-                    host: Host = gen.generate_host()
-                    self.hostQ.put(host)
+                    addr = self.addrQ.get(True, q_timeout)
+                    host: Optional[Host] = gen.resolve_host(addr)
+                    if host is not None:
+                        self.hostQ.put(host)
+                except Empty:
+                    pass
                 except ShutDown:
-                    self.log.info("gen_worker #%02d: HostQueue was shut down. I'm quitting.", wid)
+                    self.log.info("gen_worker #%02d: AddrQueue was shut down. I'm quitting.", wid)
                     return
         finally:
+            gen.close()
             self.log.info("gen_worker #%02d is finished. So long!", wid)
             with self.lock:
                 self.wcnt -= 1
 
     def _host_worker(self) -> None:
-        """Catch Hosts from the queue and add them to the database."""
+        """Catch Hosts from the queue and add them to the database.
+
+        Hosts are added in batches, one transaction per batch, so we do not pay for
+        a commit on every single Host.
+        """
         self.log.info("host_worker coming right up.")
+        batch_size: int = host_batch_min
         try:
             db: Database = Database()
             while self.active:
-                try:
-                    host: Host = self.hostQ.get(True, q_timeout)
-                    zone: Optional[str] = host.zone
-                    with db:
-                        db.host_add(host)
-                        if zone is not None:
-                            xf = db.xfr_get_by_name(zone)
-                            if xf is None:
-                                xf = XFR(name=zone)
-                                db.xfr_add(xf)
-                                db.host_set_xfr(host)
-                except Empty:
-                    pass
+                batch: list[Host] = self._drain_batch(batch_size)
+                if len(batch) == 0 or not self._store_batch(db, batch):
+                    continue
+
+                # If the batch filled up, Hosts are coming in faster than we commit
+                # them, so we take bigger bites. If it was very small, we wait a
+                # little to let the next one grow.
+                if len(batch) == batch_size:
+                    batch_size = min(batch_size * 2, host_batch_max)
+                elif len(batch) < host_batch_small:
+                    batch_size = host_batch_min
+                    time.sleep(host_batch_delay)
         finally:
             db.close()
             self.log.info("Host worker is quitting now.")
-            self.hostQ.shutdown(True)
+            # hostQ is a SimpleQueue, which cannot be shut down, but shutting
+            # down addrQ makes the gen_workers quit all the same.
+            self.addrQ.shutdown(True)
+
+    def _drain_batch(self, size: int) -> list[Host]:
+        """Take up to <size> Hosts from the queue.
+
+        We wait up to q_timeout seconds for the first Host, the rest we only take if
+        they are there already. If no Host arrives in time, return an empty list.
+        """
+        try:
+            batch: list[Host] = [self.hostQ.get(True, q_timeout)]
+        except Empty:
+            return []
+
+        while len(batch) < size:
+            try:
+                batch.append(self.hostQ.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _store_batch(self, db: Database, batch: list[Host]) -> bool:
+        """Add the Hosts in <batch> to the database and register their zones for XFR.
+
+        If the database is locked, we back off before trying again, so we do not
+        spin on the lock, and give up after host_retry_max attempts.
+        Return True if the batch was stored.
+        """
+        for attempt in range(host_retry_max):
+            try:
+                # We only look at each zone once per batch, for the first new
+                # Host in it.
+                zones: dict[str, Host] = {}
+                with db:
+                    for host in batch:
+                        zone: Optional[str] = host.zone
+                        if db.host_add(host) and zone is not None:
+                            zones.setdefault(zone, host)
+                    for zone, host in zones.items():
+                        if db.xfr_add_new(XFR(name=zone)):
+                            db.host_set_xfr(host)
+                return True
+            except sqlite3.OperationalError as operr:
+                self.log.error("%s adding %d Hosts (attempt %d of %d): %s",
+                               operr.__class__.__name__,
+                               len(batch),
+                               attempt + 1,
+                               host_retry_max,
+                               operr)
+                if attempt + 1 < host_retry_max:
+                    time.sleep(host_retry_delay * 2 ** attempt)
+
+        self.log.error("Giving up on %d Hosts.", len(batch))
+        return False
 
 # Local Variables: #
 # python-indent: 4 #
@@ -40,6 +40,14 @@ def main() -> None:
                       type=int,
                       default=2,
                       help="The number of XFR threads to run in parallel")
+    argp.add_argument("-r", "--resolver",
+                      action="append",
+                      default=[],
+                      help="Upstream DNS resolver for the Generator (may be given multiple times)")
+    argp.add_argument("-f", "--fanout",
+                      type=int,
+                      default=1,
+                      help="The number of upstream resolvers to query in parallel")
     argp.add_argument("-b", "--basedir",
                       type=pathlib.Path,
                       default=common.path.base(),
@@ -50,7 +58,9 @@ def main() -> None:
 
     nx = Nexus(gcnt=args.generator,
                xcnt=args.xfr,
-               scnt=args.scanner)
+               scnt=args.scanner,
+               resolvers=args.resolver,
+               fanout=args.fanout)
 
     try:
         nx.start()
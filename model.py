@@ -16,15 +16,12 @@ pykuang.model
 (c) 2025 Benjamin Walkenhorst
 """
 
-import re
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import IntEnum, auto
 from ipaddress import IPv4Address, IPv6Address
 from typing import Final, Optional, Union
 
-zone_pat: Final[re.Pattern] = re.compile("^[^.]+[.](.*)$")
-
 
 class HostSource(IntEnum):
     """HostSource describes how we got knowledge of a Host."""
@@ -58,10 +55,10 @@ class Host:
     @property
     def zone(self) -> Optional[str]:
         """Return the DNS zone a host belongs to."""
-        m = zone_pat.match(self.name)
-        if m is None:
+        idx: Final[int] = self.name.find(".")
+        if idx < 1:
             return None
-        return m[1]
+        return self.name[idx+1:]
 
 
 @dataclass(kw_only=True, slots=True)
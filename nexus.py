@@ -19,7 +19,7 @@ pykuang.nexus
 import logging
 from dataclasses import dataclass, field
 from queue import Queue
-from threading import RLock
+from threading import Event
 
 from pykuang import common
 from pykuang.control import Facility, Message
@@ -33,8 +33,7 @@ class Nexus:
     """Nexus brings together all the moving parts, so to speak."""
 
     log: logging.Logger = field(default_factory=lambda: common.get_logger("nexus"))
-    lock: RLock = field(default_factory=RLock)
-    _active: bool = False
+    _active: Event = field(default_factory=Event)
     cmdQ: Queue[Message] = field(init=False)
     pgen: ParallelGenerator = field(init=False)
     pxfr: XFRProcessor = field(init=False)
@@ -42,6 +41,8 @@ class Nexus:
     gcnt: int
     xcnt: int
     scnt: int
+    resolvers: list[str] = field(default_factory=list)
+    fanout: int = 1
 
     def __post_init__(self) -> None:
         assert self.gcnt > 0
@@ -49,28 +50,27 @@ class Nexus:
         assert self.scnt > 0
 
         self.cmdQ = Queue()
-        self.pgen = ParallelGenerator(wcnt=self.gcnt)
+        self.pgen = ParallelGenerator(wcnt=self.gcnt,
+                                      nameservers=self.resolvers,
+                                      fanout=self.fanout)
         self.pxfr = XFRProcessor(wcnt=self.xcnt)
         self.pscn = Scanner(wcnt=self.scnt)
 
     @property
     def active(self) -> bool:
         """Return the Nexus' active flag."""
-        with self.lock:
-            return self._active
+        return self._active.is_set()
 
     def start(self) -> None:
         """Let get this Nexus started!"""
-        with self.lock:
-            self._active = True
+        self._active.set()
         self.pxfr.start()
         self.pgen.start()
         self.pscn.start()
 
     def stop(self) -> None:
         """Tell all subsystems to stop."""
-        with self.lock:
-            self._active = True
+        self._active.clear()
         self.pxfr.stop()
         self.pgen.stop()
         self.pscn.stop()
@@ -19,29 +19,53 @@ pykuang.scanner
 
 import logging
 import random
+import re
 import socket
+import struct
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from datetime import datetime
 from ipaddress import IPv4Address, IPv6Address
 from queue import Empty, Queue, ShutDown
-from threading import RLock, Thread
-from typing import Final, NamedTuple, Optional, Union
+from threading import Event, Lock, Thread, local
+from typing import Callable, Final, NamedTuple, Optional, Union
 
 import dns
 import requests
 from dns.resolver import Resolver
-from telnetlib3 import Telnet  # type: ignore # pylint: disable-msg=E0401
+from requests.adapters import HTTPAdapter
 
 from pykuang import common
-from pykuang.control import Cmd, Message
 from pykuang.database import Database, DBError
-from pykuang.model import Host, HostSource, Service
+from pykuang.model import Host, HostSource
 
 conn_timeout: Final[float] = 2.5
+read_timeout: Final[float] = 1.0
+# SO_LINGER with a zero timeout: close() resets the connection right away.
+linger_rst: Final[bytes] = struct.pack("ii", 1, 0)
 rcv_buf: Final[int] = 256
-
-interesting_ports: Final[list[int]] = [
+# Each scan_worker keeps its own pool of HTTP connections, per host.
+http_pool_size: Final[int] = 64
+# These go out with every HTTP probe. The Host header comes from the URL.
+http_headers: Final[dict[str, str]] = {
+    "User-Agent": f"{common.AppName}/{common.AppVersion}",
+    "Accept": "*/*",
+}
+# How many pending scans per worker we keep queued up.
+scan_backlog: Final[int] = 4
+# How many scan results may wait for the gatherer.
+res_backlog: Final[int] = 1024
+# The gatherer commits scan results in batches of up to svc_batch_max, or
+# whatever arrived within svc_batch_wait seconds of the first one.
+svc_batch_max: Final[int] = 512
+svc_batch_wait: Final[float] = 0.25
+# Telnet commands: subnegotiations, option negotiations (WILL, WONT, DO, DONT),
+# and the remaining two-byte commands.
+telnet_cmd_pat: Final[re.Pattern[bytes]] = re.compile(
+    rb"\xff\xfa.*?\xff\xf0|\xff[\xfb-\xfe].|\xff[\xf0-\xfa]",
+    re.DOTALL)
+
+interesting_ports: Final[tuple[int, ...]] = (
     21,
     22,
     23,
@@ -63,7 +87,40 @@ interesting_ports: Final[list[int]] = [
     5900,
     8080,
     9023,  # possibly alternative port for telnet
-]
+)
+
+# Mail ports to try first on Hosts we found as MX, in order of preference.
+mx_ports: Final[tuple[int, ...]] = (25, 110, 143, 587)
+
+# For port selection, each of the interesting ports is represented by one bit,
+# in the same order as the tuple.
+port_bits: Final[dict[int, int]] = {p: 1 << i for i, p in enumerate(interesting_ports)}
+port_mask: Final[int] = (1 << len(interesting_ports)) - 1
+
+
+def tcp_connect(addr: str, port: int) -> socket.socket:
+    """Open a TCP connection to <addr>:<port>, <addr> being an IP address.
+
+    Unlike socket.create_connection, this does not go through getaddrinfo, which
+    is pointless for an address we already have.
+    """
+    family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+    sock: Final[socket.socket] = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        # On Linux, give up on unacknowledged data (including our SYN) after
+        # conn_timeout, no matter how many retransmissions that leaves.
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            sock.setsockopt(socket.IPPROTO_TCP,
+                            socket.TCP_USER_TIMEOUT,
+                            int(conn_timeout * 1000))
+        # Close with a RST, so the connection does not linger in TIME_WAIT.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger_rst)
+        sock.settimeout(conn_timeout)
+        sock.connect((addr, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
 
 @dataclass(kw_only=True, slots=True)
@@ -72,17 +129,17 @@ class ScanTarget:
 
     addr: Union[str, IPv4Address, IPv6Address]
     port: int
+    _astr: str = field(init=False)
 
     def __post_init__(self) -> None:
         if not 0 < self.port < 65536:
             raise ValueError(f"Invalid port {self.port}")
+        self._astr = self.addr if isinstance(self.addr, str) else str(self.addr)
 
     @property
     def astr(self) -> str:
         """Return the address as a string."""
-        if isinstance(self.addr, (IPv4Address, IPv6Address)):
-            return str(self.addr)
-        return self. addr
+        return self._astr
 
 
 class ScanReply(NamedTuple):
@@ -103,12 +160,18 @@ class ScanRequest:
         assert 0 < self.port < 65536, "Port must be a number between 1 and 65535"
 
 
-@dataclass(kw_only=True, slots=True)
-class ScanResult:
-    """ScanResult is the result scanning a port."""
+class ScanResult(NamedTuple):
+    """ScanResult is the result scanning a port.
 
-    host: Host
-    result: Service
+    It has the same layout as a row in the svc table, so the gatherer can hand
+    it to the database as it is. <added> is the time of the scan in seconds
+    since the epoch.
+    """
+
+    host_id: int
+    port: int
+    added: int
+    response: Optional[str]
 
 
 @dataclass(kw_only=True, slots=True)
@@ -116,21 +179,20 @@ class Scanner:
     """Scanner scans ports."""
 
     log: logging.Logger = field(default_factory=lambda: common.get_logger("scanner"))
-    lock: RLock = field(default_factory=RLock)
+    lock: Lock = field(default_factory=Lock)
     wcnt: int
     id_cnt: int = 1
-    cmdQ: Queue[Message] = field(init=False)
-    scanQ: Queue[ScanRequest] = field(init=False)
+    scanQ: Queue[Optional[ScanRequest]] = field(init=False)
     resQ: Queue[ScanResult] = field(init=False)
     interval: float = 2.0
-    _active: bool = False
+    _active: Event = field(default_factory=Event)
+    pool: local = field(default_factory=local)
+    _done_hosts: set[int] = field(default_factory=set)
 
     def __post_init__(self) -> None:
         assert self.wcnt > 0
-        socket.setdefaulttimeout(conn_timeout)
-        self.cmdQ = Queue(self.wcnt * 2)
-        self.scanQ = Queue(self.wcnt)
-        self.resQ = Queue(self.wcnt * 2)
+        self.scanQ = Queue(self.wcnt * scan_backlog)
+        self.resQ = Queue(res_backlog)
 
     @property
     def wid(self) -> int:
@@ -139,17 +201,43 @@ class Scanner:
             self.id_cnt += 1
             return self.id_cnt
 
+    @property
+    def session(self) -> requests.Session:
+        """Return the calling thread's HTTP session."""
+        try:
+            return self.pool.session
+        except AttributeError:
+            adapter = HTTPAdapter(pool_connections=http_pool_size,
+                                  pool_maxsize=http_pool_size,
+                                  max_retries=0)
+            session = requests.Session()
+            session.headers.update(http_headers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.pool.session = session
+            return session
+
+    @property
+    def resolver(self) -> Resolver:
+        """Return the calling thread's DNS resolver."""
+        try:
+            return self.pool.resolver
+        except AttributeError:
+            res = Resolver(configure=False)
+            res.timeout = conn_timeout
+            res.lifetime = conn_timeout
+            self.pool.resolver = res
+            return res
+
     @property
     def active(self) -> bool:
         """Return the Scanner's active flag."""
-        with self.lock:
-            return self._active
+        return self._active.is_set()
 
     def start(self) -> None:
         """Start the worker threads."""
         self.log.debug("Scanner starting up...")
-        with self.lock:
-            self._active = True
+        self._active.set()
 
         fthr = Thread(target=self._feeder, daemon=True, name="scanner.feeder")
         fthr.start()
@@ -168,12 +256,10 @@ class Scanner:
     def stop(self) -> None:
         """Tell all the worker threads to quit."""
         self.log.debug("Telling Scanner to shutdown.")
-        with self.lock:
-            self._active = False
+        self._active.clear()
 
         self.scanQ.shutdown()
         self.resQ.shutdown()
-        self.cmdQ.shutdown()
 
     def start_one(self) -> None:
         """Start another worker thread."""
@@ -183,6 +269,8 @@ class Scanner:
                       args=(wid, ),
                       daemon=True,
                       name=f"scanner.scan_worker{wid:02d}")
+        with self.lock:
+            self.wcnt += 1
         wthr.start()
 
     def stop_one(self) -> None:
@@ -192,59 +280,71 @@ class Scanner:
             if self.wcnt < 1 or not self.active:
                 self.log.error("Scanner does not appear to be active!")
                 return
-        msg = Message(Tag=Cmd.Stop)
-        self.cmdQ.put(msg)
+        # None tells the first scan_worker to pick it up to quit.
+        self.scanQ.put(None)
 
     def _feeder(self) -> None:
         self.log.debug("Feeder thread is coming up...")
-        db: Database = Database()
+        dbg: Final[bool] = self.log.isEnabledFor(logging.DEBUG)
+        # All database I/O of the feeder runs on a single helper thread, so we can
+        # fetch the next batch of Hosts while the current one is being fed to the
+        # workers. The Database is opened on that thread, too, since sqlite3
+        # connections must not be shared across threads.
+        dbx: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1,
+                                                     thread_name_prefix="scanner.db")
+        db: Database = dbx.submit(Database).result()
+        nxt: Optional[Future[list[tuple[Host, frozenset[int]]]]] = None
         try:
             while self.active:
-                with self.lock:
-                    cnt = self.wcnt
+                # Reading an int needs no lock, and if we are off by one worker
+                # for a round, no harm is done.
+                cnt = self.wcnt
                 if cnt < 1:
                     time.sleep(self.interval)
                     continue
-                hosts: list[Host] = db.host_get_random(cnt)
-                for host in hosts:
-                    req = self._select_port(db, host)
+                # We fetch enough Hosts to fill the queue and let the blocking put
+                # on scanQ pace us. That way, the workers never sit idle waiting for
+                # the next round, no matter how quickly their probes finish. We only
+                # sleep if there is nothing to scan, i.e. none of the Hosts we got
+                # has a port left to scan, or we got no Hosts at all.
+                if nxt is None:
+                    nxt = dbx.submit(db.host_get_random_with_ports, cnt * scan_backlog)
+                hosts: list[tuple[Host, frozenset[int]]] = nxt.result()
+                nxt = dbx.submit(db.host_get_random_with_ports, cnt * scan_backlog)
+                queued: int = 0
+                for host, ports in hosts:
+                    req = self._select_port(host, ports)
                     if req is not None:
                         self.scanQ.put(req)
-                    else:
+                        queued += 1
+                    elif dbg:
                         self.log.debug("No port was found for %s/%s",
                                        host.name,
                                        host.addr)
-                time.sleep(self.interval)
+                if queued == 0:
+                    time.sleep(self.interval)
         except ShutDown:
             pass
         finally:
-            db.close()
+            dbx.submit(db.close).result()
+            dbx.shutdown()
             self.log.debug("Feeder thread is quitting.")
             self.scanQ.shutdown()
-            with self.lock:
-                self._active = False
+            self._active.clear()
 
     def _scan_worker(self, wid: int) -> None:
         self.log.debug("Scan worker %02d starting up.",
                        wid)
         try:
             while self.active:
-                try:
-                    msg = self.cmdQ.get_nowait()
-                except Empty:
-                    pass
-                else:
-                    match msg.Tag:
-                        case Cmd.StopOne | Cmd.Stop:
-                            return
-                try:
-                    req: ScanRequest = self.scanQ.get(True, self.interval)
-                    res: Optional[ScanResult] = self.scan_port(req)
-                    if res is None:
-                        pass
-                except Empty:
-                    time.sleep(self.interval)
-                    continue
+                # We block until there is work. stop() shuts down the queue, which
+                # wakes us up, stop_one() sends us None.
+                req: Optional[ScanRequest] = self.scanQ.get()
+                if req is None:
+                    return
+                res: Optional[ScanResult] = self.scan_port(req)
+                if res is not None:
+                    self.resQ.put(res)
         except ShutDown:
             pass
         finally:
@@ -254,93 +354,113 @@ class Scanner:
                 self.wcnt -= 1
 
     def _gatherer(self) -> None:
-        """Gather scanned ports and store them in the database."""
+        """Gather scanned ports and store them in the database.
+
+        The gatherer is the only thread that writes scan results, and it writes
+        them in batches of up to svc_batch_max, waiting no more than svc_batch_wait
+        seconds for a batch to fill up.
+        """
         self.log.debug("Gatherer threads is starting up.")
         db: Final[Database] = Database()
+        done: bool = False
         try:
-            while self.active:
-                try:
-                    res = self.resQ.get(True, self.interval)
-                    svc: Service = res.result
+            while self.active and not done:
+                batch: list[ScanResult] = [self.resQ.get()]
+                deadline: float = time.monotonic() + svc_batch_wait
+
+                while len(batch) < svc_batch_max:
+                    remaining: float = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.resQ.get(True, remaining))
+                    except Empty:
+                        break
+                    except ShutDown:
+                        done = True
+                        break
 
+                try:
                     with db:
-                        db.service_add(svc)
-                except Empty:
-                    continue
+                        db.service_add_rows(batch)
                 except DBError as err:
-                    self.log.error("Failed to add Service to database: %s",
+                    self.log.error("Failed to add %d Services to database: %s",
+                                   len(batch),
                                    err)
         except ShutDown:
             pass
         finally:
-            with self.lock:
-                self._active = False
+            self._active.clear()
             db.close()
             self.log.debug("Gatherer thread is quitting.")
 
-    def _select_port(self, db: Database, host: Host) -> Optional[ScanRequest]:
-        """Pick a port to scan for <host>."""
-        services: list[Service] = db.service_get_by_host(host)
-        ports: Final[frozenset[int]] = frozenset({x.port for x in services})
+    def _select_port(self, host: Host, ports: frozenset[int]) -> Optional[ScanRequest]:
+        """Pick a port to scan for <host>, skipping the <ports> we already scanned."""
+        # Only the feeder thread calls us, so _done_hosts needs no lock.
+        if host.host_id in self._done_hosts:
+            return None
 
         match host.src:
             case HostSource.MX:
-                for p in (25, 110, 143, 587):
+                for p in mx_ports:
                     if p not in ports:
                         return ScanRequest(host=host, port=p)
             case HostSource.NS:
                 if 53 not in ports:
                     return ScanRequest(host=host, port=53)
 
-        plist: Final[list[int]] = random.sample(interesting_ports, len(interesting_ports))
+        scanned: int = 0
+        for p in ports:
+            scanned |= port_bits.get(p, 0)
+
+        candidates: int = port_mask & ~scanned
+
+        if candidates == 0:
+            # We've exhausted all our options.
+            # We COULD return a random number from the interval [1,65535], but for now,
+            # we just bail. Services are never removed, so the Host will stay done,
+            # and we remember that to skip it right away next time.
+            self._done_hosts.add(host.host_id)
+            return None
 
-        for p in plist:
-            if p not in ports:
-                return ScanRequest(host=host, port=p)
+        # Pick one of the remaining bits at random: Clear the lowest set bit
+        # k times, then take the lowest one that is left.
+        for _ in range(random.randrange(candidates.bit_count())):
+            candidates &= candidates - 1
 
-        # We've exhausted all our options.
-        # We COULD return a random number from the interval [1,65535], but for now,
-        # we just bail.
-        return None
+        idx: Final[int] = (candidates & -candidates).bit_length() - 1
+        return ScanRequest(host=host, port=interesting_ports[idx])
 
     def scan_port(self, req: ScanRequest) -> Optional[ScanResult]:
         """Scan a port."""
         try:
-            match req.port:
-                case 21 | 22 | 25 | 110 | 143 | 220:
-                    reply = self.scan_tcp_generic(req.host.astr, req.port)
-                case 80 | 443 | 8080:
-                    reply = self.scan_http(req.host.astr, req.port, req.host.name, req.port == 443)
-                case 79:
-                    reply = self.scan_finger(req.host.astr, req.port)
-                case 23 | 3270 | 9023:
-                    reply = self.scan_telnet(req.host.astr, req.port)
-                case _:
-                    #  self.log.debug("Don't know how to handle port %d", req.port)
-                    return None
+            probe: Callable[[Scanner, ScanRequest], ScanReply] = \
+                port_handlers.get(req.port, probe_tcp_generic)
+            reply: ScanReply = probe(self, req)
 
             if reply.status:
-                svc: Final[Service] = Service(
-                    host_id=req.host.host_id,
-                    port=req.port,
-                    added=datetime.now(),
-                    response=reply.response,
-                )
-                return ScanResult(host=req.host, result=svc)
+                return ScanResult(req.host.host_id,
+                                  req.port,
+                                  int(time.time()),
+                                  reply.response)
             return None
         except TimeoutError:
             return None
 
     def scan_tcp_generic(self, addr: str, port: int) -> ScanReply:
         """Open a TCP connection and report what is received."""
-        if not 0 < port < 65536:
-            raise ValueError(f"Invalid port {port}")
         try:
-            conn = socket.create_connection((addr, port))
-            response = conn.recv(rcv_buf)
-            conn.close()
+            with tcp_connect(addr, port) as conn:
+                # Once we are connected, the port is open. Plenty of services
+                # wait for the client to speak first, so if no banner arrives
+                # quickly, we report the port without one.
+                conn.settimeout(read_timeout)
+                try:
+                    response = conn.recv(rcv_buf)
+                except TimeoutError:
+                    return ScanReply(True, "")
 
-            return ScanReply(True, str(response))
+            return ScanReply(True, response.decode("utf-8", "replace").strip())
         except ConnectionError as cerr:
             cname: Final[str] = cerr.__class__.__name__
             msg = f"{cname} trying to connect to {addr}:{port}: {cerr}"
@@ -363,16 +483,24 @@ class Scanner:
                   hostname: Optional[str] = None,
                   ssl: bool = False) -> ScanReply:
         """Attempt to scan an HTTP server."""
-        if not 0 < port < 65536:
-            raise ValueError(f"Invalid port {port}")
         try:
-            schema: Final[str] = "https" if ssl else "http"
-            if hostname is not None:
-                uri: str = f"{schema}://{hostname}:{port}/"
+            headers: Optional[dict[str, str]] = None
+            if ssl and hostname is not None:
+                # TLS needs the hostname for SNI and to check the certificate,
+                # so here we have to let requests resolve it.
+                uri: str = f"https://{hostname}:{port}/"
             else:
-                uri = f"{schema}://{addr}:{port}/"
-
-            response = requests.head(uri, timeout=conn_timeout)
+                # We already know the address, so there is no point in looking up
+                # the name again. We pass it in the Host header instead.
+                schema: Final[str] = "https" if ssl else "http"
+                host: Final[str] = f"[{addr}]" if ":" in addr else addr
+                uri = f"{schema}://{host}:{port}/"
+                if hostname is not None:
+                    headers = {"Host": hostname if port == 80 else f"{hostname}:{port}"}
+
+            response = self.session.head(uri,
+                                         headers=headers,
+                                         timeout=(conn_timeout, read_timeout))
             if "Server" in response.headers:
                 return ScanReply(True, response.headers["Server"])
             return ScanReply(True, "---")
@@ -389,10 +517,8 @@ class Scanner:
 
     def scan_dns(self, addr: str, port: int) -> ScanReply:
         """Attempt to query a DNS server for its server string."""
-        if not 0 < port < 65536:
-            raise ValueError(f"Invalid port {port}")
         try:
-            res = Resolver("", False)
+            res = self.resolver
             res.nameservers = [addr]
 
             ans = res.resolve("version.bind.", "TXT", "CH")
@@ -408,33 +534,39 @@ class Scanner:
 
     def scan_finger(self, addr: str, port: int) -> ScanReply:
         """Attempt to finger a finger server."""
-        if not 0 < port < 65536:
-            raise ValueError(f"Invalid port {port}")
-
         try:
-            conn = socket.create_connection((addr, port))
-            conn.send(b"root\r\n")
+            with tcp_connect(addr, port) as conn:
+                conn.send(b"root\r\n")
+                response = conn.recv(rcv_buf)
 
-            response = conn.recv(rcv_buf)
-
-            return ScanReply(True, response.decode())
+            return ScanReply(True, response.decode("utf-8", "replace").strip())
         except ConnectionError as cerr:
             cname: Final[str] = cerr.__class__.__name__
             msg = f"{cname} trying to connect to {addr}:{port}: {cerr}"
             self.log.error(msg)
             return ScanReply(False, msg)
+        except OSError as oerr:
+            oname: Final[str] = oerr.__class__.__name__
+            msg = f"{oname} trying to connect to {addr}:{port}: {oerr}"
+            self.log.debug(msg)
+            return ScanReply(False, msg)
 
     def scan_telnet(self, addr: str, port: int) -> ScanReply:
-        """Attempt to scan a telnet server."""
-        if not 0 < port < 65536:
-            raise ValueError(f"Invalid port {port}")
-
-        conn: Optional[Telnet] = None
+        """Attempt to scan a telnet server.
 
+        We do not negotiate any options, we only read what the server sends on
+        its own and strip the telnet commands from it.
+        """
         try:
-            conn = Telnet(addr, port)
-            data = conn.read_until(b"Sapperlot", conn_timeout)
-            return ScanReply(True, data.decode())
+            with tcp_connect(addr, port) as conn:
+                conn.settimeout(read_timeout)
+                try:
+                    data = conn.recv(rcv_buf)
+                except TimeoutError:
+                    return ScanReply(True, "")
+
+            data = telnet_cmd_pat.sub(b"", data)
+            return ScanReply(True, data.decode("utf-8", "replace").strip())
         except ConnectionError as cerr:
             cname: Final[str] = cerr.__class__.__name__
             msg = f"{cname} trying to connect to {addr}:{port}: {cerr}"
@@ -444,9 +576,27 @@ class Scanner:
             return ScanReply(False, "Timeout")
         except OSError as oerr:
             return ScanReply(False, str(oerr))
-        finally:
-            if conn is not None:
-                conn.close()
+
+
+def probe_tcp_generic(scn: Scanner, req: ScanRequest) -> ScanReply:
+    """Scan a port we have no specific probe for."""
+    return scn.scan_tcp_generic(req.host.astr, req.port)
+
+
+# port_handlers maps the ports we have a specific probe for to that probe.
+# Everything else is handled by probe_tcp_generic.
+port_handlers: Final[dict[int, Callable[[Scanner, ScanRequest], ScanReply]]] = {
+    53: lambda scn, req: scn.scan_dns(req.host.astr, req.port),
+    79: lambda scn, req: scn.scan_finger(req.host.astr, req.port),
+    **dict.fromkeys((80, 443, 8080),
+                    lambda scn, req: scn.scan_http(req.host.astr,
+                                                   req.port,
+                                                   req.host.name,
+                                                   req.port == 443)),
+    **dict.fromkeys((23, 3270, 9023),
+                    lambda scn, req: scn.scan_telnet(req.host.astr, req.port)),
+}
+
 
 # def scan_snmp(self, addr: str, port: int) -> ScanReply:
 #     """Attempt to scan an SNMP server."""
@@ -77,6 +77,24 @@ class TestNameBlacklist(unittest.TestCase):
             m: bool = bl.is_match(c[0])
             self.assertEqual(m, c[1])
 
+    def test_03_hit_count(self) -> None:
+        """Test that a match is counted for the pattern that matched."""
+        bl: Final[NameBlacklist] = NameBlacklist.from_list(["\\.invalid\\.?", "^mail\\."])
+
+        self.assertTrue(bl.is_match("mail.example.com"))
+        self.assertFalse(bl.is_match("www.example.com"))
+
+        hits: Final[dict[str, int]] = {x.pat.pattern: x.hit_cnt for x in bl.patterns}
+        self.assertEqual(hits, {"\\.invalid\\.?": 0, "^mail\\.": 1})
+
+    def test_04_groups(self) -> None:
+        """Test that backreferences keep referring to their own pattern's group."""
+        bl: Final[NameBlacklist] = NameBlacklist.from_list(["^(mail)\\d+\\.", "^(\\w+)\\.\\1\\."])
+
+        self.assertTrue(bl.is_match("www.www.example.com"))
+        self.assertTrue(bl.is_match("mail01.example.com"))
+        self.assertFalse(bl.is_match("www.example.com"))
+
 
 class TestIPBlacklist(unittest.TestCase):
     """The the IPBlacklist."""
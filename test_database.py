@@ -18,13 +18,15 @@ pykuang.test_database
 
 import os
 import shutil
+import sqlite3
 import unittest
 from datetime import datetime
-from ipaddress import ip_address
+from ipaddress import IPv4Network
+from itertools import islice
 from typing import Final, Optional
 
 from pykuang import common
-from pykuang.database import Database
+from pykuang.database import Database, host_chunk_size
 from pykuang.model import XFR, Host, HostSource
 
 test_dir: Final[str] = os.path.join(
@@ -70,9 +72,10 @@ class TestDatabase(unittest.TestCase):
         """Attempt adding a couple of Hosts to the Database."""
         db: Database = self.db()
 
+        net: Final[IPv4Network] = IPv4Network("172.16.32.0/24")
+
         with db:
-            for i in range(host_count):
-                addr = ip_address(f"172.16.32.{i+1}")
+            for i, addr in enumerate(islice(net.hosts(), host_count)):
                 name = f"host{i+1:02d}.example.com"
 
                 host: Host = Host(
@@ -120,6 +123,39 @@ class TestDatabase(unittest.TestCase):
                 db.xfr_add(x)
                 self.assertGreater(x.zone_id, 0)
 
+    def test_06_host_add_rows(self) -> None:
+        """Attempt adding more Hosts than fit into a single statement."""
+        db: Final[Database] = self.db()
+        cnt: Final[int] = host_chunk_size * 2 + 3
+        net: Final[IPv4Network] = IPv4Network("172.16.64.0/22")
+        stamp: Final[int] = int(datetime.now().timestamp())
+        rows: list[tuple[str, str, int, int]] = \
+            [(f"row{i+1:03d}.example.com", str(addr), HostSource.XFR.value, stamp)
+             for i, addr in enumerate(islice(net.hosts(), cnt))]
+
+        with db:
+            self.assertEqual(db.host_add_rows(rows), cnt)
+        with db:
+            self.assertEqual(db.host_add_rows(rows), 0)
+
+        self.assertEqual(len(db.host_get_all()), host_count + cnt)
+
+    def test_07_failed_commit(self) -> None:
+        """Test that a failed COMMIT leaves no transaction behind."""
+        db: Final[Database] = self.db()
+        stamp: Final[int] = int(datetime.now().timestamp())
+
+        # With foreign keys checked at the end of the transaction, a Service for
+        # a Host that does not exist makes the COMMIT fail.
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db:
+                db.db.execute("PRAGMA defer_foreign_keys = true")
+                db.service_add_rows([(1_000_000, 22, stamp, "SSH-2.0-OpenSSH_9.6")])
+
+        with db:
+            self.assertEqual(db.service_add_rows([]), 0)
+
+
 # Local Variables: #
 # python-indent: 4 #
 # End: #
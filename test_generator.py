@@ -19,12 +19,13 @@ pykuang.test_generator
 
 import os
 import shutil
+import time
 import unittest
 from datetime import datetime
 from typing import Final, Optional
 
 from pykuang import common
-from pykuang.generator import HostGenerator
+from pykuang.generator import CircuitBreaker, HostGenerator
 from pykuang.model import Host
 
 test_dir: Final[str] = os.path.join(
@@ -83,6 +84,55 @@ class TestHostGenerator(unittest.TestCase):
             hosts.append(h)
 
 
+class TestCircuitBreaker(unittest.TestCase):
+    """Test the CircuitBreaker."""
+
+    ns: Final[str] = "192.0.2.53"
+    threshold: Final[int] = 3
+    window: Final[float] = 0.2
+
+    def tripped(self) -> CircuitBreaker:
+        """Return a CircuitBreaker that considers our nameserver broken."""
+        cb: Final[CircuitBreaker] = CircuitBreaker(threshold=self.threshold,
+                                                   window=self.window)
+        for _ in range(self.threshold + 1):
+            cb.failure(self.ns)
+        return cb
+
+    def test_01_trip(self) -> None:
+        """Test that a nameserver is broken once it exceeds the threshold."""
+        cb: Final[CircuitBreaker] = CircuitBreaker(threshold=self.threshold,
+                                                   window=self.window)
+
+        for _ in range(self.threshold):
+            cb.failure(self.ns)
+        self.assertEqual(cb.cooldown(self.ns), 0)
+
+        cb.failure(self.ns)
+        self.assertGreater(cb.cooldown(self.ns), 0)
+        self.assertLessEqual(cb.cooldown(self.ns), self.window)
+        self.assertEqual(cb.cooldown("198.51.100.53"), 0)
+
+    def test_02_half_open(self) -> None:
+        """Test that a single failure after the cooldown breaks a nameserver again."""
+        cb: Final[CircuitBreaker] = self.tripped()
+
+        time.sleep(self.window)
+        self.assertEqual(cb.cooldown(self.ns), 0)
+
+        cb.failure(self.ns)
+        self.assertGreater(cb.cooldown(self.ns), 0)
+
+    def test_03_recovery(self) -> None:
+        """Test that a successful trial query lets a nameserver recover."""
+        cb: Final[CircuitBreaker] = self.tripped()
+
+        time.sleep(self.window)
+        cb.success(self.ns)
+        cb.failure(self.ns)
+        self.assertEqual(cb.cooldown(self.ns), 0)
+
+
 # Local Variables: #
 # python-indent: 4 #
 # End: #
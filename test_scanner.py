@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Time-stamp: <2026-10-15 14:21:37 krylon>
+#
+# /data/code/python/pykuang/test_scanner.py
+# created on 15. 10. 2026
+# (c) 2026 Benjamin Walkenhorst
+#
+# This file is part of the PyKuang network scanner. It is distributed under the
+# terms of the GNU General Public License 3. See the file LICENSE for details
+# or find a copy online at https://www.gnu.org/licenses/gpl-3.0
+
+"""
+pykuang.test_scanner
+
+(c) 2026 Benjamin Walkenhorst
+"""
+
+import os
+import shutil
+import socket
+import unittest
+from datetime import datetime
+from ipaddress import ip_address
+from threading import Thread
+from typing import Final, Optional
+
+from pykuang import common
+from pykuang.model import Host, HostSource
+from pykuang.scanner import (ScanReply, ScanRequest, Scanner,
+                             interesting_ports, mx_ports)
+
+test_dir: Final[str] = os.path.join(
+    "/tmp",
+    datetime.now().strftime(f"{common.AppName.lower()}_test_scanner_%Y%m%d_%H%M%S"))
+# Ports are picked at random, so we ask often enough to see every candidate.
+select_rounds: Final[int] = 500
+# A telnet server greeting, with option negotiations (DO TERMINAL-TYPE, WILL ECHO)
+# and a subnegotiation mixed in.
+telnet_greeting: Final[bytes] = \
+    b"\xff\xfd\x18\xff\xfb\x01Welcome to \xff\xfa\x18\x01\xff\xf0srv01\r\nlogin: "
+
+
+def select_port(scn: Scanner, host: Host, ports: frozenset[int]) -> Optional[ScanRequest]:
+    """Ask <scn> to pick a port to scan for <host>."""
+    return scn._select_port(host, ports)  # pylint: disable-msg=W0212
+
+
+class TestSelectPort(unittest.TestCase):
+    """Test picking the port to scan for a Host."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Prepare the testing environment."""
+        common.set_basedir(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Clean up afterwards."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def host(self, host_id: int, src: HostSource = HostSource.Generator) -> Host:
+        """Return a Host to pick ports for."""
+        return Host(host_id=host_id,
+                    name=f"host{host_id:02d}.example.com",
+                    addr=ip_address(f"172.16.32.{host_id}"),
+                    src=src)
+
+    def test_01_unscanned_ports(self) -> None:
+        """Test that only interesting ports that were not scanned, yet, are picked."""
+        scn: Final[Scanner] = Scanner(wcnt=1)
+        host: Final[Host] = self.host(1)
+        scanned: Final[frozenset[int]] = frozenset(interesting_ports[::2]) | {8443}
+        picked: set[int] = set()
+
+        for _ in range(select_rounds):
+            req: Optional[ScanRequest] = select_port(scn, host, scanned)
+            assert req is not None
+            self.assertIs(req.host, host)
+            picked.add(req.port)
+
+        self.assertEqual(picked, set(interesting_ports) - scanned)
+
+    def test_02_all_done(self) -> None:
+        """Test that a Host is done once all interesting ports have been scanned."""
+        scn: Final[Scanner] = Scanner(wcnt=1)
+        host: Final[Host] = self.host(2)
+
+        self.assertIsNone(select_port(scn, host, frozenset(interesting_ports)))
+        # Once a Host is done, it stays done.
+        self.assertIsNone(select_port(scn, host, frozenset()))
+
+    def test_03_mx_first(self) -> None:
+        """Test that mail ports come first for MX Hosts."""
+        scn: Final[Scanner] = Scanner(wcnt=1)
+        host: Final[Host] = self.host(3, HostSource.MX)
+
+        req: Optional[ScanRequest] = select_port(scn, host, frozenset(mx_ports[:1]))
+        assert req is not None
+        self.assertEqual(req.port, mx_ports[1])
+
+
+class TestProbes(unittest.TestCase):
+    """Test the probes against local servers."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Prepare the testing environment."""
+        common.set_basedir(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Clean up afterwards."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def serve(self, greeting: bytes) -> int:
+        """Accept one connection on a local port, send <greeting>, and hang up.
+
+        Return the port number.
+        """
+        srv: Final[socket.socket] = socket.create_server(("127.0.0.1", 0))
+
+        def handle() -> None:
+            with srv:
+                conn, _ = srv.accept()
+                with conn:
+                    conn.sendall(greeting)
+
+        Thread(target=handle, daemon=True).start()
+        return srv.getsockname()[1]
+
+    def test_01_telnet_banner(self) -> None:
+        """Test that telnet commands are stripped from the banner."""
+        scn: Final[Scanner] = Scanner(wcnt=1)
+        port: Final[int] = self.serve(telnet_greeting)
+
+        reply: Final[ScanReply] = scn.scan_telnet("127.0.0.1", port)
+        self.assertTrue(reply.status)
+        self.assertEqual(reply.response, "Welcome to srv01\r\nlogin:")
+
+
+# Local Variables: #
+# python-indent: 4 #
+# End: #
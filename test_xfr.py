@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Time-stamp: <2026-10-15 15:08:52 krylon>
+#
+# /data/code/python/pykuang/test_xfr.py
+# created on 15. 10. 2026
+# (c) 2026 Benjamin Walkenhorst
+#
+# This file is part of the PyKuang network scanner. It is distributed under the
+# terms of the GNU General Public License 3. See the file LICENSE for details
+# or find a copy online at https://www.gnu.org/licenses/gpl-3.0
+
+"""
+pykuang.test_xfr
+
+(c) 2026 Benjamin Walkenhorst
+"""
+
+import os
+import shutil
+import socket
+import unittest
+from datetime import datetime
+from functools import partial
+from threading import Thread
+from typing import Final
+from unittest.mock import patch
+
+import dns.message
+import dns.name
+import dns.query
+import dns.rdata
+import dns.rrset
+
+from pykuang import common
+from pykuang.model import XFR, Host
+from pykuang.xfr import XFRClient
+
+test_dir: Final[str] = os.path.join(
+    "/tmp",
+    datetime.now().strftime(f"{common.AppName.lower()}_test_xfr_%Y%m%d_%H%M%S"))
+zone_name: Final[str] = "zone01.kuang-test.net"
+# The zone our fake nameserver hands out, in the order it sends the records.
+# An AXFR starts and ends with the zone's SOA record.
+zone_records: Final[list[tuple[str, str, str]]] = [
+    ("@", "SOA", "ns1 hostmaster 1 3600 600 86400 300"),
+    ("@", "NS", "ns1"),
+    ("@", "MX", "10 mail"),
+    ("@", "A", "93.184.216.34"),
+    ("www", "A", "93.184.216.35"),
+    ("www", "AAAA", "2606:2800:220:1::1946"),
+    ("www", "TXT", "\"v=spf1 -all\""),
+    # Blacklisted, but only as a fully qualified name.
+    ("dip-1", "A", "93.184.216.36"),
+    ("@", "SOA", "ns1 hostmaster 1 3600 600 86400 300"),
+]
+
+
+def serve_zone() -> int:
+    """Answer one AXFR query for our test zone on a local port.
+
+    Return the port number.
+    """
+    srv: Final[socket.socket] = socket.create_server(("127.0.0.1", 0))
+    origin: Final[dns.name.Name] = dns.name.from_text(zone_name)
+
+    def handle() -> None:
+        with srv:
+            conn, _ = srv.accept()
+            with conn:
+                query, _ = dns.query.receive_tcp(conn)
+                response = dns.message.make_response(query)
+                for name, rdtype, rdata in zone_records:
+                    rd = dns.rdata.from_text("IN", rdtype, rdata,
+                                             origin=origin,
+                                             relativize=False)
+                    response.answer.append(
+                        dns.rrset.from_rdata(dns.name.from_text(name, origin), 300, rd))
+                dns.query.send_tcp(conn, response)
+
+    Thread(target=handle, daemon=True).start()
+    return srv.getsockname()[1]
+
+
+class TestXFRClient(unittest.TestCase):
+    """Test the XFRClient against a local nameserver."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Prepare the testing environment."""
+        common.set_basedir(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Clean up afterwards."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_01_attempt_xfr(self) -> None:
+        """Test that the Hosts from a zone transfer are stored with full names."""
+        xc: Final[XFRClient] = XFRClient()
+        xfr: Final[XFR] = XFR(name=zone_name)
+        port: Final[int] = serve_zone()
+
+        # attempt_xfr always talks to port 53, so we point it to our server.
+        with patch("dns.query.xfr", partial(dns.query.xfr, port=port)):
+            self.assertTrue(xc.attempt_xfr(xfr, "127.0.0.1"))
+
+        hosts: Final[list[Host]] = xc.db.host_get_all()
+        xc.close()
+
+        # Only address records give us Hosts, and the blacklists see the same
+        # names we store.
+        self.assertEqual({(h.name, str(h.addr)) for h in hosts},
+                         {(zone_name, "93.184.216.34"),
+                          (f"www.{zone_name}", "93.184.216.35"),
+                          (f"www.{zone_name}", "2606:2800:220:1::1946")})
+
+
+# Local Variables: #
+# python-indent: 4 #
+# End: #
@@ -21,29 +21,46 @@ import logging
 import time
 import traceback
 from dataclasses import dataclass, field
-from datetime import datetime
 from ipaddress import IPv4Address, IPv6Address, ip_address
-from queue import Empty, Queue
-from sqlite3 import IntegrityError
-from threading import Lock, RLock, Thread, local
+from operator import itemgetter
+from queue import Empty, Queue, ShutDown
+from threading import Event, Lock, RLock, Thread, local
 from typing import Final, Optional, Sequence, Union
 
 import dns
 from dns import rdatatype
 from dns.exception import DNSException, Timeout
-from dns.node import Node, NodeKind
 from dns.rcode import Rcode
 from dns.rdatatype import RdataType
-from dns.resolver import (NXDOMAIN, LifetimeTimeout, NoAnswer, NoNameservers,
-                          Resolver)
+from dns.resolver import (NXDOMAIN, LifetimeTimeout, LRUCache, NoAnswer,
+                          NoNameservers, Resolver)
+from dns.rrset import RRset
 
 from pykuang import common
 from pykuang.blacklist import IPBlacklist, NameBlacklist
 from pykuang.control import Cmd, Message
 from pykuang.database import Database, DBError
-from pykuang.model import XFR, Host, HostSource
+from pykuang.model import XFR, HostSource
 
 q_timeout: Final[Union[float, int]] = 2.5
+# While receiving a zone, we add the Hosts to the database whenever we have
+# collected this many.
+xfr_batch_size: Final[int] = 1000
+# We cache up to this many DNS answers. Zones hosted by the same provider often
+# share their nameservers.
+res_cache_size: Final[int] = 10_000
+# The cache is shared by all XFRClients, so a nameserver one worker has looked
+# up already is known to the others as well. LRUCache does its own locking.
+res_cache: Final[LRUCache] = LRUCache(res_cache_size)
+# A nameserver that sends nothing for this many seconds during a zone transfer
+# is given up on, so we can move on to the next one.
+xfr_timeout: Final[float] = 10.0
+# When there are no unstarted zones in the database, the XFR feeder waits before
+# it asks again. The wait starts at feed_delay_min seconds and doubles every time
+# the feeder comes up empty, up to feed_delay_max. While all unstarted zones are
+# already queued, it waits feed_delay_min seconds.
+feed_delay_min: Final[float] = 2.0
+feed_delay_max: Final[float] = 30.0
 
 
 @dataclass(kw_only=True, slots=True)
@@ -61,11 +78,14 @@ class XFRClient:
     name_blacklist: NameBlacklist = field(init=False)
     net_blacklist: IPBlacklist = field(init=False)
     pool: local = field(default_factory=local)
+    dbg: bool = field(init=False)
 
     def __post_init__(self) -> None:
+        self.dbg = self.log.isEnabledFor(logging.DEBUG)
         self.cmdQ = Queue(self.wcnt)
         self.xfrQ = Queue(self.wcnt)
         self.res = Resolver()
+        self.res.cache = res_cache
         self.name_blacklist = NameBlacklist.default()
         self.net_blacklist = IPBlacklist.default()
 
@@ -83,6 +103,15 @@ class XFRClient:
         """Return the client's active flag."""
         return self._active
 
+    def close(self) -> None:
+        """Close the calling thread's database connection, if it has one."""
+        try:
+            db: Database = self.pool.db
+        except AttributeError:
+            return
+        db.close()
+        del self.pool.db
+
     def resolve_name(self, name: str) -> Optional[Union[IPv4Address, IPv6Address]]:
         """Attempt to resolve a hostname to an IP address."""
         try:
@@ -96,15 +125,25 @@ class XFRClient:
         return None
 
     def lookup_ns(self, xfr: XFR) -> Sequence[Union[str, IPv4Address, IPv6Address]]:
-        """Attempt to look up the nameservers for a given zone."""
+        """Attempt to look up the nameservers for a given zone.
+
+        Nameservers whose address was included in the reply are returned as
+        addresses, the others by name.
+        """
         try:
-            servers: list[str] = []
+            servers: list[Union[str, IPv4Address, IPv6Address]] = []
             reply = self.res.resolve(xfr.name, rdatatype.NS)
             match reply.response.rcode():
                 case Rcode.NOERROR if reply.rrset is not None:
+                    # If the reply comes with glue records, we use those addresses
+                    # right away and save ourselves another lookup.
+                    glue: Final[dict[str, Union[IPv4Address, IPv6Address]]] = {}
+                    for rrset in reply.response.additional:
+                        if rrset.rdtype in (RdataType.A, RdataType.AAAA):
+                            glue.setdefault(rrset.name.to_text(), ip_address(rrset[0].address))
                     for srv in reply.rrset:
                         addr: str = srv.to_text()
-                        servers.append(addr)
+                        servers.append(glue.get(addr, addr))
                 case _:
                     self.log.error("NS query for %s returned %s",
                                    xfr.name,
@@ -127,23 +166,42 @@ class XFRClient:
         return servers
 
     def attempt_xfr(self, xfr: XFR, ns: str) -> bool:
-        """Attempt to query <ns> for an XFR of <xfr>."""
+        """Attempt to query <ns> for an XFR of <xfr>.
+
+        We process the transfer message by message as it arrives, instead of
+        building the whole zone in memory first, and add the Hosts we find to the
+        database in batches of xfr_batch_size.
+        """
         status: bool = False
         cnt: int = 0
-        now = datetime.now()
+        stamp: Final[int] = int(time.time())
         bl_cnt: int = 0
+        rows: list[tuple[str, str, int, int]] = []
         try:
-            zone = dns.zone.from_xfr(dns.query.xfr(ns, xfr.name))
-
-            for key, node in zone.nodes.items():
-                cnt += 1
-                name: str = key.to_text()
-                if self.name_blacklist.is_match(name):
-                    bl_cnt += 1
-                    continue
-                self.log.debug("Got one item: %s", name)
-                if node.classify() == NodeKind.REGULAR:
-                    self._process_node(xfr.name, now, name, node)
+            # By default, dnspython gives us names relative to the zone, but we
+            # want to store and check the full names.
+            for msg in dns.query.xfr(ns, xfr.name, timeout=xfr_timeout, relativize=False):
+                for rrset in msg.answer:
+                    cnt += len(rrset)
+                    # Only address records give us Hosts, so we skip everything
+                    # else wholesale instead of looking at each record.
+                    if rrset.rdtype not in (RdataType.A, RdataType.AAAA):
+                        if self.dbg:
+                            self.log.debug("Don't know how to handle %s records, yet.",
+                                           rrset.rdtype.name)
+                        continue
+                    name: str = rrset.name.to_text(omit_final_dot=True)
+                    if self.name_blacklist.is_match(name):
+                        bl_cnt += len(rrset)
+                        continue
+                    self._process_rrset(name, stamp, rrset, rows)
+
+                if len(rows) >= xfr_batch_size:
+                    self._store(rows)
+                    rows.clear()
+
+            if len(rows) > 0:
+                self._store(rows)
 
             status = True
         except (EOFError, OSError) as terr:
@@ -159,43 +217,43 @@ class XFRClient:
 
         return status
 
-    def _process_node(self, zone: str, now: datetime, name: str, node: Node) -> None:
+    def _store(self, rows: list[tuple[str, str, int, int]]) -> None:
+        """Add a batch of host <rows> to the database.
+
+        The rows are sorted by address first, so the inserts walk the address
+        index in order rather than jumping around in it.
+        """
+        rows.sort(key=itemgetter(1))
         db = self.db
-        for rd in node.rdatasets:
-            records = list(rd.items.keys())
-            # self.log.debug("Handle Rdataset %s => %s",
-            #                name,
-            #                ", ".join([r.to_text() for r in records]))
-
-            for r in records:
-                self.log.debug("Got one %s record: %s",
-                               r.rdtype.name,
-                               r)
-                match r.rdtype:
-                    # XXX I need to assemble the name from the RDATA and the zone I am slurping,
-                    #     so end up with useful hostnames instead of "ns1".
-                    case RdataType.A | RdataType.AAAA:
-                        if self.net_blacklist.is_match(r.address):
-                            continue
-                        h: Host = Host(name=f"{name}.{zone}",
-                                       addr=ip_address(r.address),
-                                       src=HostSource.XFR,
-                                       added=now)
-                        self.log.debug("Add Host %s/%s to database",
-                                       h.name,
-                                       h.addr)
-                        if self.net_blacklist.is_match(h.addr) or \
-                           self.name_blacklist.is_match(h.name):
-                            continue
-                        try:
-                            with db:
-                                db.host_add(h)
-                        except IntegrityError:
-                            continue
-                    case RdataType.MX:
-                        self.log.debug("Don't know how to handle MX records, yet.")
-                    case RdataType.NS:
-                        self.log.debug("Don't know how to handle NS records, yet.")
+        with db:
+            db.host_add_rows(rows)
+
+    def _process_rrset(self,
+                       name: str,
+                       stamp: int,
+                       rrset: RRset,
+                       rows: list[tuple[str, str, int, int]]) -> None:
+        """Append the Hosts found in <rrset> to <rows>, as rows for the host table.
+
+        For large zones, building a Host for every record only to take it apart
+        again for the database would be a waste.
+        """
+        # Zones can be large, so we look these up once, not for every record.
+        src: Final[int] = HostSource.XFR.value
+        addr_blacklisted = self.net_blacklist.is_match
+        dbg: Final[bool] = self.dbg
+        # We know the address family from the record type, so there is no need
+        # for ip_address to guess it for every record.
+        parse_addr = IPv4Address if rrset.rdtype == RdataType.A else IPv6Address
+
+        for r in rrset:
+            if addr_blacklisted(parse_addr(r.address)):
+                continue
+            if dbg:
+                self.log.debug("Add Host %s/%s to database",
+                               name,
+                               r.address)
+            rows.append((name, r.address, src, stamp))
 
     def perform_xfr(self, xfr: XFR) -> bool:
         """Attempt a DNS zone transfer."""
@@ -217,7 +275,7 @@ class XFRClient:
                 # self.log.debug("Querying %s for AXFR of %s",
                 #                ns,
                 #                xfr.name)
-                addr = self.resolve_name(str(ns))
+                addr = self.resolve_name(ns) if isinstance(ns, str) else ns
                 if addr is None:
                     continue
                 if self.attempt_xfr(xfr, str(addr)):
@@ -244,8 +302,9 @@ class XFRProcessor:
     lock: Lock = field(default_factory=Lock)
     requestQ: Queue[XFR] = field(init=False)
     cmdQ: Queue[Message] = field(init=False)
-    _active: bool = False
+    _active: Event = field(default_factory=Event)
     _id_cnt: int = 0
+    _pending: set[str] = field(default_factory=set)
     wcnt: int
 
     def __post_init__(self) -> None:
@@ -256,13 +315,13 @@ class XFRProcessor:
     @property
     def active(self) -> bool:
         """Return the Processor's active flag."""
-        with self.lock:
-            return self._active
+        return self._active.is_set()
 
     def start(self) -> None:
         """Raise the active flag, start the worker threads."""
+        self._active.set()
+
         with self.lock:
-            self._active = True
             cnt = self.wcnt
 
         fthr = Thread(target=self._feeder, daemon=True, name="xfr.feeder")
@@ -276,13 +335,11 @@ class XFRProcessor:
         if not self.active:
             return
 
-        with self.lock:
-            self._active = False
-            cnt: Final[int] = self.wcnt
-
-        for _ in range(cnt):
-            msg: Message = Message(Tag=Cmd.Stop)
-            self.cmdQ.put(msg)
+        self._active.clear()
+        # Shutting down the queue wakes up all workers waiting for an XFR, so they
+        # quit right away. Zones still in the queue have not been started yet,
+        # so nothing is lost by dropping them.
+        self.requestQ.shutdown(immediate=True)
 
     def start_one(self) -> None:
         """If active, start one more worker thread."""
@@ -310,21 +367,41 @@ class XFRProcessor:
             msg: Message = Message(Tag=Cmd.Stop)
             self.cmdQ.put(msg)
             if self.wcnt == 1:
-                self._active = False
+                self._active.clear()
 
     def _feeder(self) -> None:
         """Feed XFR requests to the workers."""
         self.log.debug("XFR Feeder starting up.")
         db = Database()
+        delay: float = feed_delay_min
         try:
             while self.active:
                 zones = db.xfr_get_unstarted(self.wcnt)
                 if len(zones) == 0:
-                    time.sleep(2)
+                    time.sleep(delay)
+                    delay = min(delay * 2, feed_delay_max)
                     continue
 
+                delay = feed_delay_min
+                queued: int = 0
+
+                # A zone counts as unstarted until a worker gets to it, so we
+                # are likely to see zones again that are still in the queue.
+                # We keep track of those, so each zone is only transferred once.
                 for x in zones:
+                    with self.lock:
+                        if x.name in self._pending:
+                            continue
+                        self._pending.add(x.name)
                     self.requestQ.put(x)
+                    queued += 1
+
+                # Zones we have queued before are waiting for a worker, or being
+                # transferred right now, so we check again soon.
+                if queued == 0:
+                    time.sleep(feed_delay_min)
+        except ShutDown:
+            pass
         finally:
             db.close()
 
@@ -354,10 +431,17 @@ class XFRProcessor:
                                 self.log.error("Message payload is not a number!")
                 try:
                     x: XFR = self.requestQ.get(True, q_timeout)
-                    xc.perform_xfr(x)
                 except Empty:
-                    pass
+                    continue
+                try:
+                    xc.perform_xfr(x)
+                finally:
+                    with self.lock:
+                        self._pending.discard(x.name)
+        except ShutDown:
+            self.log.info("XFR worker %02d will quit now.", wid)
         finally:
+            xc.close()
             with self.lock:
                 self.wcnt -= 1
 